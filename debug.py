@@ -2,10 +2,11 @@
 Programmer: Chris Tralie
 Purpose: Some utilities to help with debugging, including conversion to
 JFLAP and a method to test all strings up to a certain size in an alphabet
-against Python's built-in regular expression evaluator
+against Python's built-in regular expression evaluator (or RE2, if it's installed)
 """
 
-import numpy as np
+from bisect import bisect_left
+from math import cos, sin, pi
 
 def get_state_info(delta, width):
     """
@@ -33,31 +34,39 @@ def get_state_info(delta, width):
         raise KeyError("JFLAP renderer expects a state called 'Finish' in the transitions")
     if not "Start" in states:
         raise KeyError("JFLAP renderer expects a state called 'Start' in the transitions")
-    counts = [sum([c == "_" for c in key]) for key in states]
+    counts = [key.count("_") for key in states]
     ## Step 1: Figure out order of singleton keys
     keys_single = [key for (key, count) in zip(states, counts) if count == 1]
-    keys_single = sorted(keys_single, key=lambda x: int(x[2::]))
+    single_num = {k:int(k[k.index("_")+1:]) for k in keys_single}
+    keys_single = sorted(keys_single, key=single_num.get)
     following = {k:[] for k in keys_single}
 
+    lens = {k:len(k) for k in states}
+    # States that start with k are next to each other in sorted
+    # order, right after k itself
+    states_sorted = sorted(states)
     for k in keys_single:
-        for k2 in states:
-            if len(k2) > len(k) and k2[0:len(k)] == k:
-                following[k].append(k2)
+        i = bisect_left(states_sorted, k)
+        while i < len(states_sorted) and states_sorted[i].startswith(k):
+            if lens[states_sorted[i]] > lens[k]:
+                following[k].append(states_sorted[i])
+            i += 1
     
     ids = {}
     idx = 1
     for k in keys_single:
         ids[k] = idx
         idx += 1
-        for k2 in sorted(following[k], key=lambda x: -len(x)):
+        for k2 in sorted(following[k], key=lambda x: -lens[x]):
             ids[k2] = idx
             idx += 1
     ids["Start"] = 0
     ids["Finish"] = len(ids)+1
     pos = {}
+    inv_n = 1.0/len(ids)
     for k, id in ids.items():
-        theta = np.pi*id/len(ids)
-        pos[k] = (width*(1-np.cos(theta)), width*np.sin(theta))
+        theta = pi*id*inv_n
+        pos[k] = (width*(1-cos(theta)), width*sin(theta))
     return pos, ids
     
 
@@ -76,13 +85,11 @@ def write_dfa_jflap(delta, filename):
     filename: string
         Path to which to write JFLAP file
     """
-    import numpy as np
     BEGIN_JFF = """<?xml version="1.0" encoding="UTF-8" standalone="no"?><!--Created with substring.py in Ursinus College CS 373--><structure>
         <type>fa</type>
         <automaton>"""
     ## Step 1: Setup the states
-    jff_string = "" + BEGIN_JFF
-    states_xml = ""
+    parts = [BEGIN_JFF]
 
     delta_orig = delta
     # Convert to (State):(Character:State)
@@ -103,25 +110,23 @@ def write_dfa_jflap(delta, filename):
             d = "<initial/>"
         if state == "Finish":
             d = "<final/>"
-        states_xml += "<state id=\"{}\" name=\"{}\">\n    <x>{}</x>    <y>{}</y>\n{}</state>".format(id, state, x, y, d)
+        parts.append("<state id=\"{}\" name=\"{}\">\n    <x>{}</x>    <y>{}</y>\n{}</state>".format(id, state, x, y, d))
     ## Step 2: Setup the transitions
-    jff_string += states_xml
     for state_from in delta.keys():
         state_from_id = ids[state_from]
         for c in delta[state_from].keys():
             for state_to in delta[state_from][c]:
                 state_to = ids[state_to]
-                jff_string += "<transition>\n    <from>{}</from>\n    <to>{}</to>\n    ".format(state_from_id, state_to)
+                parts.append("<transition>\n    <from>{}</from>\n    <to>{}</to>\n    ".format(state_from_id, state_to))
                 if c:
-                    jff_string += "<read>{}</read>".format(c)
+                    parts.append("<read>{}</read>".format(c))
                 else:
                     # Lambda arrow
-                    jff_string += "<read/>"
-                jff_string += "</transition>\n"
-    jff_string += "</automaton></structure>"
-    fout = open(filename, "w")
-    fout.write(jff_string)
-    fout.close()
+                    parts.append("<read/>")
+                parts.append("</transition>\n")
+    parts.append("</automaton></structure>")
+    with open(filename, "w") as fout:
+        fout.write("".join(parts))
 
 
 def cmp_python(rexp, Sigma, max_len):
@@ -138,25 +143,28 @@ def cmp_python(rexp, Sigma, max_len):
     max_len: int
         Maximum length of string
     """
-    from re import fullmatch # Python's version
+    try:
+        # RE2 matches in linear time, so it can't blow up on
+        # regular expressions that make Python's re backtrack
+        import re2 as re
+    except ImportError:
+        import re # Python's version
+    from itertools import product
     from mygrep import eval_regexp
-    queue = [""]
-    finished = False
-    # Go through strings in lexicographic order, as per the order in Sigma
+    ref = re.__name__ # Which engine we're comparing against
+    fullmatch = re.compile(rexp).fullmatch
+    # Go through strings in lexicographic order, as per the order in Sigma,
+    # one length at a time (no queue needed)
     correct = 0
     tried = 0
-    while not finished:
-        s = queue.pop(0)
-        if len(s) > max_len:
-            finished = True
-        else:
+    for length in range(max_len+1):
+        for chars in product(Sigma, repeat=length):
+            s = "".join(chars)
             tried += 1
             myres = eval_regexp(rexp, s)
-            pyres = fullmatch(rexp, s) is not None
-            if myres != pyres:
-                print("Wrong on {}: Mine {}, Python {}".format(s, myres, pyres))
+            refres = fullmatch(s) is not None
+            if myres != refres:
+                print("Wrong on {}: Mine {}, {} {}".format(s, myres, ref, refres))
             else:
                 correct += 1
-            for c in Sigma:
-                queue.append(s+c)
-    print("{} / {} Correct on {} up to length {}".format(correct, tried, rexp, max_len))
\ No newline at end of file
+    print("{} / {} Correct on {} up to length {} (compared to {})".format(correct, tried, rexp, max_len, ref))
\ No newline at end of file
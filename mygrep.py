@@ -1,6 +1,95 @@
+import re
+from array import array
+from functools import lru_cache
+
+def freeze(delta, F, q=None):
+    """
+    Convert an NFA into a form that uses integers everywhere, so that
+    it can be simulated without hashing any strings.  The states in
+    delta are numbered 0, 1, ..., N-1, and sets of states are stored
+    as the bits of an int
+
+    Parameters
+    ----------
+    delta: (string, string) -> set([string])
+        Transition function, where None is a lambda arrow
+    F: set([string])
+        Accept states
+    q: string
+        Start state, if there is one
+    
+    Returns
+    -------
+    adj: list of list of int
+        adj[i][j] is a bitmask of the states that state i goes to
+        on the character with index j
+    accept_mask: int
+        Bitmask of the accept states
+    q_id: int
+        Index of the start state, or -1 if q is None
+    char_idx: string -> int
+        Index of each character, including None for lambda
+    states: list of string
+        Name of each state
+    """
+    ## Number the states in the order they're first seen, so that
+    ## state labels don't have to be comparable
+    states = {}
+    if q is not None:
+        states[q] = None
+    char_idx = {}
+    for (p, c), states_to in delta.items():
+        states[p] = None
+        for state_to in states_to:
+            states[state_to] = None
+        if not c in char_idx:
+            char_idx[c] = len(char_idx)
+    states.update(dict.fromkeys(F))
+    states = list(states)
+    state_id = {state:i for i, state in enumerate(states)}
+    adj = [[0]*len(char_idx) for state in states]
+    for (p, c), states_to in delta.items():
+        row = adj[state_id[p]]
+        j = char_idx[c]
+        for state_to in states_to:
+            row[j] |= 1 << state_id[state_to]
+    accept_mask = 0
+    for f in F:
+        accept_mask |= 1 << state_id[f]
+    q_id = -1
+    if q is not None:
+        q_id = state_id[q]
+    return adj, accept_mask, q_id, char_idx, states
+
+
+def _bits(mask):
+    """
+    Return the indices of the bits that are set in mask, from lowest to highest
+    """
+    if not mask & (mask-1):
+        # Zero or one bits, which is the usual case
+        if mask:
+            return [mask.bit_length()-1]
+        return []
+    bits = []
+    while mask:
+        low = mask & -mask
+        bits.append(low.bit_length()-1)
+        mask ^= low
+    return bits
+
+
+## eval_nfa freezes the NFA first for strings longer than this
+## many times the number of entries in delta
+_FREEZE_FACTOR = 4
+
 def eval_nfa(s, q, delta, F, verbose=False):
     """
-    Evaluate a standard NFA with no lambda arrows
+    Evaluate a standard NFA with no lambda arrows.  Freezing the NFA 
+    only pays for itself on strings that are long compared to delta, 
+    so shorter strings are checked with sets of states directly.  To 
+    check many strings against the same NFA, freeze it once and call 
+    eval_nfa_frozen instead
      
     Parameters
     ----------
@@ -15,6 +104,9 @@ def eval_nfa(s, q, delta, F, verbose=False):
     verbose: bool
         If True, print info about sequence of states that are visited
     """
+    if len(s) > _FREEZE_FACTOR*len(delta):
+        adj, accept_mask, q_id, char_idx, names = freeze(delta, F, q)
+        return eval_nfa_frozen(s, adj, accept_mask, q_id, char_idx, verbose, names)
     states = set([q]) ## We now track multiple possibilities
     if verbose:
         print("Start", states)
@@ -24,12 +116,51 @@ def eval_nfa(s, q, delta, F, verbose=False):
             if (p, c) in delta:
                 ## This line is different from DFA; there are multiple
                 ## states we can branch out to; track the unique ones
-                next_states = next_states.union(delta[(p, c)])
+                next_states.update(delta[(p, c)])
         states = next_states
         if verbose:
             print(c, states)
     ## At least one state must be in the set of accept states F
-    return len(states.intersection(F)) > 0
+    return not states.isdisjoint(F)
+
+
+def eval_nfa_frozen(s, adj, accept_mask, q_id, char_idx, verbose=False, names=None):
+    """
+    Evaluate a standard NFA with no lambda arrows that's
+    been converted with freeze
+     
+    Parameters
+    ----------
+    s: string
+        Input to try
+    adj, accept_mask, q_id, char_idx:
+        The NFA, as returned by freeze
+    verbose: bool
+        If True, print info about sequence of states that are visited
+    names: list of string
+        Name of each state, as returned by freeze, to use when verbose
+    """
+    states = 1 << q_id ## We now track multiple possibilities
+    if verbose:
+        print("Start", set([names[q_id]]))
+    for c in s:
+        j = char_idx.get(c)
+        if j is None:
+            ## No state has an arrow on this character
+            return False
+        next_states = 0
+        b = states
+        while b:
+            ## Pull off the lowest set bit and branch out to
+            ## all of the states it can reach
+            i = (b & -b).bit_length()-1
+            next_states |= adj[i][j]
+            b &= b-1
+        states = next_states
+        if verbose:
+            print(c, set([names[i] for i in _bits(states)]))
+    ## At least one state must be in the set of accept states F
+    return (states & accept_mask) != 0
 
 
 def get_reachable_lambdas(start, delta):
@@ -66,6 +197,122 @@ def get_reachable_lambdas(start, delta):
     return reachable
 
 
+def get_lambda_closures(lam_adj, columns=()):
+    """
+    Compute every state's lambda closure in a single pass by finding
+    the strongly connected components of the lambda arrows with
+    Tarjan's algorithm.  Tarjan's finds the components in reverse
+    topological order, so the closures of everything a component
+    points to are already done by the time we get to it.  Any other
+    per-state bitmasks can be ORed over the closures in the same pass
+
+    Parameters
+    ----------
+    lam_adj: list of int
+        lam_adj[i] is a bitmask of the states with a
+        lambda arrow from state i
+    columns: list of list of int
+        Each column[i] is a bitmask for state i.  These are updated
+        as a side effect, so that column[i] becomes the OR of
+        column[k] over all states k in the closure of i
+    
+    Returns
+    -------
+    list of int
+        Bitmask of the states reachable from each state by a
+        sequence of lambda arrows, including the state itself
+    """
+    N = len(lam_adj)
+    lam_succ = [_bits(mask) if mask else () for mask in lam_adj]
+    index = [-1]*N
+    low = [0]*N
+    on_stack = [False]*N
+    stack = []
+    closure = [1 << i for i in range(N)]
+    counter = 0
+    for root in range(N):
+        if index[root] >= 0 or not lam_adj[root]:
+            continue
+        # Do the depth-first search without recursion. Each entry is
+        # a state and the index of the next lambda arrow to follow
+        work = [(root, 0)]
+        while len(work) > 0:
+            v, k = work.pop()
+            if k == 0:
+                index[v] = counter
+                low[v] = counter
+                counter += 1
+                stack.append(v)
+                on_stack[v] = True
+            else:
+                # Just came back from the state at arrow k-1
+                low[v] = min(low[v], low[lam_succ[v][k-1]])
+            succ = lam_succ[v]
+            recursed = False
+            while k < len(succ):
+                u = succ[k]
+                k += 1
+                if index[u] < 0:
+                    if not lam_adj[u]:
+                        # No lambda arrows out, so u is a component 
+                        # by itself and its closure is just u
+                        index[u] = counter
+                        counter += 1
+                    else:
+                        work.append((v, k))
+                        work.append((u, 0))
+                        recursed = True
+                        break
+                elif on_stack[u]:
+                    low[v] = min(low[v], index[u])
+            if recursed or low[v] != index[v]:
+                continue
+            # v is the root of a component; pop it off and
+            # give all of its states the same closure
+            if stack[-1] == v:
+                # A component with just v, which is most of them
+                stack.pop()
+                on_stack[v] = False
+                reach = closure[v]
+                for w in succ:
+                    reach |= closure[w]
+                closure[v] = reach
+                for column in columns:
+                    x = column[v]
+                    for w in succ:
+                        x |= column[w]
+                    column[v] = x
+                continue
+            members = 0
+            component = []
+            u = -1
+            while u != v:
+                u = stack.pop()
+                on_stack[u] = False
+                members |= 1 << u
+                component.append(u)
+            # Components that this one has lambda arrows to
+            outside = []
+            for u in component:
+                for w in lam_succ[u]:
+                    if not members & (1 << w):
+                        outside.append(w)
+            reach = members
+            for w in outside:
+                reach |= closure[w]
+            for u in component:
+                closure[u] = reach
+            for column in columns:
+                x = 0
+                for u in component:
+                    x |= column[u]
+                for w in outside:
+                    x |= column[w]
+                for u in component:
+                    column[u] = x
+    return closure
+
+
 def reduce_nfa_lambdas(delta, F):
     """
     Eliminate the lambdas in an NFA by doing a reduction
@@ -79,117 +326,335 @@ def reduce_nfa_lambdas(delta, F):
     F: set([string])
         Final states, which will be updated as as side effect
     """
-    ## Step 1: Copy the dictionary into a new format where
-    ## it's more convenient to look up only the arrows coming
-    ## out of a particular state
-    delta_state = {} #(State):(Character:set(states))
-    for (state, c), states_to in delta.items():
-        if not state in delta_state:
-            delta_state[state] = {}
-        if not c in delta_state[state]:
-            delta_state[state][c] = set([])
-        delta_state[state][c].update(states_to)
-
-    ## Step 2: Loop through each state, get the new arrows, and 
-    ## update the final states
-    states = set([key[0] for key in delta])
-    F_new = set([])
-    for state in states:
-        # Get states that are reachable from this state
-        reachable = get_reachable_lambdas(state, delta)
-        # Figure out if this should be an accept state based
-        # on what's reachable
-        if len(reachable.intersection(F)) > 0:
-            F_new.add(state)
-        # Add the new arrows
-        for other in reachable:
-            if other in delta_state: # If there are actually any arrows coming out of this state
-                for c, states_to in delta_state[other].items():
-                    if c is not None:
-                        # Add this new equivalent arrow
-                        if not (state, c) in delta:
-                            delta[(state, c)] = set([])
-                        delta[(state, c)] = delta[(state, c)].union(states_to)
-    F.update(F_new)
+    ## Step 1: Freeze the NFA and pull out the column of
+    ## arrows for each character
+    adj, accept_mask, _, char_idx, names = freeze(delta, F)
+    if not None in char_idx:
+        return
+    lam = char_idx[None]
+    chars = [c for c in char_idx if c is not None]
+    before = [[row[char_idx[c]] for row in adj] for c in chars]
+    after = [list(column) for column in before]
+
+    ## Step 2: In one pass over the lambda arrows, compute each state's
+    ## closure, and OR each character's column over it.  The arrows out
+    ## of a state on c go to everything the states in its closure go to on c
+    lam_adj = [row[lam] for row in adj]
+    closure = get_lambda_closures(lam_adj, after)
+    # Only states with lambda arrows out of them can change
+    lam_states = [i for i in range(len(names)) if lam_adj[i]]
+
+    ## Step 3: Figure out which states should be accept states
+    ## based on what's reachable from them
+    F.update([names[i] for i in lam_states if closure[i] & accept_mask])
+
+    ## Step 4: Add the arrows that are new
+    for c, column, new_column in zip(chars, before, after):
+        for i in lam_states:
+            states_to = new_column[i] & ~column[i]
+            if states_to:
+                # Add this new equivalent arrow
+                if not (names[i], c) in delta:
+                    delta[(names[i], c)] = set([])
+                delta[(names[i], c)].update(names[k] for k in _bits(states_to))
      
-    ## Step 3: Remove the original lambda arrows
+    ## Step 5: Remove the original lambda arrows
     to_remove = [key for key in delta.keys() if key[1] is None]
     for key in to_remove:
         del delta[key]
 
 
+def nfa_to_dfa(delta, q, F, max_states=None):
+    """
+    Use the subset construction to convert an NFA with no lambda
+    arrows into a DFA whose transitions are stored in a flat table.
+    The DFA can have exponentially many states, so this gives up
+    past max_states
+
+    Parameters
+    ----------
+    delta: (string, string) -> set([string])
+        Transition function
+    q: string
+        Start state
+    F: set([string])
+        Accept states
+    max_states: int
+        If not None, the most DFA states to make
+    
+    Returns
+    -------
+    None if the DFA would have more than max_states states, or
+    table: array of int
+        table[i*K + j] is the DFA state reached from state i on the
+        character with index j, where K = len(char_index), or -1
+        if there is no such state
+    accept: set([int])
+        Accept states of the DFA
+    char_index: string -> int
+        Index of each character in the alphabet
+    n_states: int
+        Number of DFA states.  The start state is 0
+    """
+    adj, accept_mask, q_id, char_idx, _ = freeze(delta, F, q)
+    chars = [j for c, j in char_idx.items() if c is not None]
+    char_index = {c:k for k, c in enumerate([c for c in char_idx if c is not None])}
+
+    ## Each DFA state is a bitmask of NFA states.  Number them
+    ## in the order they're discovered
+    start = 1 << q_id
+    ids = {start:0}
+    subsets = [start]
+    table = array("i")
+    accept = set([])
+    i = 0
+    while i < len(subsets):
+        subset = subsets[i]
+        if subset & accept_mask:
+            accept.add(i)
+        members = _bits(subset)
+        for j in chars:
+            states_to = 0
+            for p in members:
+                states_to |= adj[p][j]
+            if states_to == 0:
+                table.append(-1)
+            else:
+                if not states_to in ids:
+                    if max_states is not None and len(subsets) == max_states:
+                        return None
+                    ids[states_to] = len(subsets)
+                    subsets.append(states_to)
+                table.append(ids[states_to])
+        i += 1
+    return table, accept, char_index, len(subsets)
+
+
+## Splits an infix expression into an escaped character, an operator,
+## or an ordinary character
+_TOK = re.compile(r"\\(.)|([*|()])|(.)", re.S)
+## Classes of the tokens in an infix expression, looked up by ord(c)
+_OPERAND, _STAR, _UNION, _OPEN, _CLOSE = range(5)
+_CLASS = bytearray(128)
+_CLASS[ord("*")] = _STAR
+_CLASS[ord("|")] = _UNION
+_CLASS[ord("(")] = _OPEN
+_CLASS[ord(")")] = _CLOSE
+
 def infix2postfix(expr):
     """
     Convert an infix specification of a regular expression into
     a postfix version.
     If two adjacent characters do not include ()*|, 
     then insert a . (concatenate) in between them
-    Also insert a . (concatenate) after every *
+    Also insert a . (concatenate) after a * or ) that is
+    followed by an operand or (
 
     Parameters
     ----------
     expr: string
         Regular expression in infix form
     
-    Returns
-    -------
-    An array of the postfix expression, which includes ()*|. for operators,
-    and which includes "c_i" for the operands, where c is the character
-    and i is the index
+    Yields
+    ------
+    The tokens of the postfix expression in order, which includes *|. for 
+    operators, and which includes "c_i" for the operands, where c is the 
+    character and i is the index.  An empty alternative or group, as in 
+    a| or (), is the operand "_i", which matches the empty string.  Use list(infix2postfix(expr)) if you
+    need them all at once
 
     Precedence: star > concatenation > union
     """
-    ## Step 1: Convert infix string into infix list, escaping characters, 
-    ## converting to c_i, and inserting concatenation . where necessary
-    i = 0
+    ## Tokenize the string, escaping characters, converting to c_i, and 
+    ## inserting concatenation . where necessary, while converting to 
+    ## postfix in the same pass.  Star has the highest precedence and
+    ## applies to what's just been output, so it's output right away,
+    ## and the stack only ever holds ( . and |
     idx = 0
-    infix = []
-    while i < len(expr):
-        if expr[i] in "*|()":
-            infix.append(expr[i])
-            if expr[i] == "*" and i < len(expr)-1:
-                infix.append(".")
+    stack = []
+    concat = False # Nothing to concatenate with at the beginning
+    for escaped, x, c in _TOK.findall(expr):
+        if x:
+            cls = _CLASS[ord(x)]
+            if cls == _STAR:
+                yield x
+            elif cls == _UNION:
+                if not concat:
+                    # Empty alternative
+                    yield "_%d" % idx
+                    idx += 1
+                while len(stack) > 0 and stack[-1] != "(":
+                    yield stack.pop()
+                stack.append(x)
+                concat = False
+            elif cls == _OPEN:
+                # A ( that follows an operand, ) or * is concatenated
+                if concat:
+                    while len(stack) > 0 and stack[-1] == ".":
+                        yield stack.pop()
+                    stack.append(".")
+                stack.append(x)
+                concat = False
+            else:
+                if not concat:
+                    # Empty alternative or group
+                    yield "_%d" % idx
+                    idx += 1
+                while len(stack) > 0 and stack[-1] != "(":
+                    yield stack.pop()
+                stack.pop()
+                concat = True
         else:
-            if expr[i] == "\\": # Escape character
-                i += 1
-            c = expr[i]
-            infix.append("{}_{}".format(c, idx))
+            # So is an operand
+            if concat:
+                while len(stack) > 0 and stack[-1] == ".":
+                    yield stack.pop()
+                stack.append(".")
+            yield "%s_%d" % (escaped or c, idx)
             idx += 1
-            if i < len(expr)-1 and expr[i+1] not in "*|)":
-                infix.append(".")
-        i += 1
+            concat = True
     
-    ## Step 2: Convert infix list to postfix list
-    precedence = {"*":2, ".":1, "|":0}
-    postfix = []
+    if len(expr) > 0 and not concat:
+        # Empty alternative at the end
+        yield "_%d" % idx
+    
+    ## Pop the rest of the operators from the stack
+    while len(stack) > 0:
+        yield stack.pop()
+
+
+def postfix2nfa(postfix):
+    """
+    Use Thompson's construction to convert a postfix regular expression
+    into an NFA with lambda arrows.  Each operand c_i gets a state "c_i"
+    with an arrow on c to a state "c_i_end" (a lambda arrow for the 
+    empty operand "_i"), and the states added by the operators are 
+    named after the states they wrap
+
+    Parameters
+    ----------
+    postfix: iterable of string
+        Postfix expression, as yielded by infix2postfix
+    
+    Returns
+    -------
+    delta: (string, string) -> set([string])
+        Transition function, where None is a lambda arrow
+    q: string
+        Start state ("Start")
+    F: set([string])
+        Accept states ({"Finish"})
+    """
+    delta = {}
+    def add_arrow(p, c, q):
+        if not (p, c) in delta:
+            delta[(p, c)] = set([])
+        delta[(p, c)].add(q)
+    
+    ## Each item on the stack is a (start, end) pair for one piece
     stack = []
-    for x in infix:
-        if x in precedence.keys():
-            while len(stack) > 0 and stack[-1] != "(" and precedence[x] <= precedence[stack[-1]]:
-                postfix.append(stack.pop())
-            stack.append(x)
-        elif x == "(":
-            stack.append(x)
-        elif x == ")":
-            while len(stack) > 0 and stack[-1] != "(":
-                postfix.append(stack.pop())
-            stack.pop()
+    for x in postfix:
+        if x == "*":
+            (start, end) = stack.pop()
+            new_start = start + "_*start"
+            new_end = end + "_*end"
+            add_arrow(new_start, None, start)
+            add_arrow(end, None, new_end)
+            add_arrow(new_start, None, new_end) # Zero times
+            add_arrow(new_end, None, new_start) # Go around again
+            stack.append((new_start, new_end))
+        elif x == ".":
+            (start2, end2) = stack.pop()
+            (start1, end1) = stack.pop()
+            add_arrow(end1, None, start2)
+            stack.append((start1, end2))
+        elif x == "|":
+            (start2, end2) = stack.pop()
+            (start1, end1) = stack.pop()
+            new_start = start1 + "_|start"
+            new_end = end2 + "_|end"
+            add_arrow(new_start, None, start1)
+            add_arrow(new_start, None, start2)
+            add_arrow(end1, None, new_end)
+            add_arrow(end2, None, new_end)
+            stack.append((new_start, new_end))
         else:
-            # Ordinary operand
-            postfix.append(x)
+            # Ordinary operand c_i, or _i for the empty string
+            c = x[0:x.rindex("_")]
+            if c == "":
+                c = None
+            add_arrow(x, c, x + "_end")
+            stack.append((x, x + "_end"))
     
-    ## Step 3: Pop the rest of the operators from the stack
-    while len(stack) > 0:
-        postfix.append(stack.pop())
-    return postfix
+    if len(stack) == 0:
+        # Empty expression only matches the empty string
+        add_arrow("Start", None, "Finish")
+    else:
+        (start, end) = stack.pop()
+        add_arrow("Start", None, start)
+        add_arrow(end, None, "Finish")
+    return delta, "Start", set(["Finish"])
+
+
+def _compile(R):
+    """
+    Convert a regular expression into an equivalent NFA without
+    lambda arrows
+
+    Parameters
+    ----------
+    R: string
+        Regular expression
+    
+    Returns
+    -------
+    delta: (string, string) -> set([string])
+        Transition function
+    q: string
+        Start state
+    F: set([string])
+        Accept states
+    """
+    delta, q, F = postfix2nfa(infix2postfix(R))
+    reduce_nfa_lambdas(delta, F)
+    return delta, q, F
+
+
+## Most DFA states eval_regexp will make before it
+## sticks with simulating the NFA
+_MAX_DFA_STATES = 4096
+
+@lru_cache(maxsize=256)
+def _compile_dfa(R):
+    """
+    Convert a regular expression into a DFA, as returned by nfa_to_dfa,
+    or into a frozen NFA, as returned by freeze, if the DFA would have
+    more than _MAX_DFA_STATES states.  This is cached by R so that 
+    checking many strings against the same expression only does the 
+    conversion once, so the results must not be modified
+
+    Returns
+    -------
+    dfa: tuple
+        The DFA, or None if it was too big
+    nfa: tuple
+        The frozen NFA if dfa is None, or None otherwise
+    """
+    delta, q, F = _compile(R)
+    dfa = nfa_to_dfa(delta, q, F, _MAX_DFA_STATES)
+    if dfa is None:
+        return None, freeze(delta, F, q)
+    return dfa, None
 
 
 def eval_regexp(R, s):
     """
     Check to see if a string s is part of a regular expression R
     by converting R into an NFA and checking to see if that NFA accepts s
-    This is an efficient algorithm that takes O(len(R)len(s)) time
-    in the worst case
+    The NFA is determinized into a DFA once per R, after which each
+    check takes O(len(s)) time.  If the DFA would be too big, the NFA 
+    is simulated instead, which takes O(len(R)len(s)) time in the 
+    worst case
 
     Parameters
     ----------
@@ -198,5 +663,18 @@ def eval_regexp(R, s):
     s: string
         String we're checking
     """
-    pass
-    ## TODO: Fill this in
+    dfa, nfa = _compile_dfa(R)
+    if dfa is None:
+        adj, accept_mask, q_id, char_idx, _ = nfa
+        return eval_nfa_frozen(s, adj, accept_mask, q_id, char_idx)
+    table, accept, char_index, _ = dfa
+    K = len(char_index)
+    state = 0
+    for c in s:
+        j = char_index.get(c)
+        if j is None:
+            return False
+        state = table[state*K + j]
+        if state < 0:
+            return False
+    return state in accept